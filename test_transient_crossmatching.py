@@ -0,0 +1,110 @@
+""" Checks that the closed-form covariance / Mahalanobis code matches the original matrix formulas. """
+import numpy as np
+import pytest
+
+import transient_crossmatching as tc
+
+# (a, b, theta) in degrees: rotated ellipses of different sizes and orientations
+ELLIPSES = [(0.01, 0.004, -30.0), (0.05, 0.02, 75.0), (0.002, 0.001, 0.0), (0.1, 0.03, 135.0)]
+# (frb ra, frb dec, transient ra, transient dec): off-axis offsets, including one at high declination
+POSITIONS = [(150.0, 2.0, 150.004, 2.003), (10.0, -45.0, 9.99, -44.995),
+             (200.0, 80.0, 200.03, 80.002), (300.0, 30.0, 300.0, 30.0)]
+
+
+def baseline_cov_matrix(a, b, theta):
+    theta_rad = np.radians(theta + 90)
+    R = np.array([[np.cos(theta_rad), -np.sin(theta_rad)],
+                  [np.sin(theta_rad), np.cos(theta_rad)]])
+    D = np.diag([a**2, b**2])
+    return R @ D @ R.T
+
+
+def baseline_mahalanobis_distance(point, frbcenter, cov_matrix):
+    diff = np.array(point) - np.array(frbcenter)
+    correction = diff[0] * (1 / np.cos(np.radians(point[1])))
+    diff_corrected = np.array([correction, diff[1]])
+    return np.sqrt(diff_corrected.T @ np.linalg.inv(cov_matrix) @ diff_corrected)
+
+
+@pytest.mark.parametrize('a, b, theta', ELLIPSES)
+def test_cov_matrix_matches_baseline(a, b, theta):
+    np.testing.assert_allclose(tc.cov_matrix(a, b, theta), baseline_cov_matrix(a, b, theta),
+                               rtol=1e-12, atol=1e-20)
+
+
+def test_cov_matrix_batch_matches_baseline():
+    a, b, theta = map(np.array, zip(*ELLIPSES))
+    expected = np.array([baseline_cov_matrix(*e) for e in ELLIPSES])
+    np.testing.assert_allclose(tc.cov_matrix_batch(a, b, theta), expected, rtol=1e-12, atol=1e-20)
+
+
+@pytest.mark.parametrize('a, b, theta', ELLIPSES)
+@pytest.mark.parametrize('frb_ra, frb_dec, ra, dec', POSITIONS)
+def test_mahalanobis_distance_matches_baseline(a, b, theta, frb_ra, frb_dec, ra, dec):
+    cov = baseline_cov_matrix(a, b, theta)
+    expected = baseline_mahalanobis_distance([ra, dec], [frb_ra, frb_dec], cov)
+    # lists, the original call style, as well as tuples
+    np.testing.assert_allclose(tc.mahalanobis_distance([ra, dec], [frb_ra, frb_dec], cov), expected, rtol=1e-10)
+    np.testing.assert_allclose(tc.mahalanobis_distance((ra, dec), (frb_ra, frb_dec), cov), expected, rtol=1e-10)
+
+
+def test_mahalanobis_distance_batch_matches_baseline():
+    points, centers, covs, expected = [], [], [], []
+    for e in ELLIPSES:
+        for frb_ra, frb_dec, ra, dec in POSITIONS:
+            cov = baseline_cov_matrix(*e)
+            points.append([ra, dec])
+            centers.append([frb_ra, frb_dec])
+            covs.append(cov)
+            expected.append(baseline_mahalanobis_distance([ra, dec], [frb_ra, frb_dec], cov))
+    np.testing.assert_allclose(tc.mahalanobis_distance_batch(points, centers, covs), expected, rtol=1e-10)
+
+
+def test_percentile_matches_chi2_cdf():
+    chi2 = pytest.importorskip('scipy.stats').chi2
+    md = np.array([0.0, 0.1, 1.0, 2.5, 4.0])
+    np.testing.assert_allclose(tc.percentile(md), chi2.cdf(md**2, 2), rtol=1e-12)
+
+
+def ellipse_points(frb_ra, frb_dec, cov, k, scale, n=72):
+    # points at scale * the chi2=k ellipse, undoing the 1/cos(dec) correction on RA
+    L = np.linalg.cholesky(cov)
+    angles = np.linspace(0, 2 * np.pi, n, endpoint=False)
+    d = scale * np.sqrt(k) * (L @ np.array([np.cos(angles), np.sin(angles)]))
+    dec = frb_dec + d[1]
+    ra = frb_ra + d[0] * np.cos(np.radians(dec))
+    return np.column_stack([ra, dec])
+
+
+@pytest.mark.parametrize('a, b, theta', ELLIPSES)
+@pytest.mark.parametrize('frb_ra, frb_dec, ra, dec', POSITIONS)
+def test_in_bounding_box_keeps_points_inside_ellipse(a, b, theta, frb_ra, frb_dec, ra, dec):
+    cov = tc.cov_matrix(a, b, theta)
+    k = -2.0 * np.log1p(-0.9999)
+    # just inside the boundary (rounding could put points exactly on it either side), and well inside
+    for scale in (1 - 1e-9, 0.5, 0.0):
+        points = ellipse_points(frb_ra, frb_dec, cov, k, scale)
+        centers = np.tile([frb_ra, frb_dec], (len(points), 1))
+        covs = np.tile(cov, (len(points), 1, 1))
+        assert tc.in_bounding_box(points, centers, covs).all()
+        # and they really are within the 99.99% ellipse
+        assert (tc.mahalanobis_distance_batch(points, centers, covs) ** 2 <= k * (1 + 1e-6)).all()
+
+
+@pytest.mark.parametrize('a, b, theta', ELLIPSES)
+@pytest.mark.parametrize('frb_ra, frb_dec, ra, dec', POSITIONS)
+def test_in_bounding_box_rejects_points_outside_box(a, b, theta, frb_ra, frb_dec, ra, dec):
+    cov = tc.cov_matrix(a, b, theta)
+    k = -2.0 * np.log1p(-0.9999)
+    step = 1 + 1e-6
+    rmax_ra = np.sqrt(k * cov[0, 0]) * step
+    rmax_dec = np.sqrt(k * cov[1, 1]) * step
+    points = np.array([
+        [frb_ra, frb_dec + rmax_dec],
+        [frb_ra, frb_dec - rmax_dec],
+        [frb_ra + rmax_ra * np.cos(np.radians(frb_dec)), frb_dec],
+        [frb_ra - rmax_ra * np.cos(np.radians(frb_dec)), frb_dec],
+    ])
+    centers = np.tile([frb_ra, frb_dec], (len(points), 1))
+    covs = np.tile(cov, (len(points), 1, 1))
+    assert not tc.in_bounding_box(points, centers, covs).any()
@@ -2,28 +2,51 @@
 @author: Yuxin Dong
 last edited: Oct 24, 2024 """
 import numpy as np
-import pandas as pd
 import json
+import logging
 import time
 import requests
 import os
-import sys
-from collections import OrderedDict
+import asyncio
+import threading
+import zipfile
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from astropy.coordinates import SkyCoord
-import ligo.skymap.plot # KEEP: needed for projections in matplotlib
 from astropy import units as u
 
-from scipy.stats import chi2
 from astropy.io import ascii
 
-from matplotlib.patches import Ellipse
-import matplotlib.pyplot as plt
-import matplotlib
-
 
 import argparse
 
+try:
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError:
+    # numba is optional; without it the kernels below just run as plain NumPy
+    HAS_NUMBA = False
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+try:
+    import aiohttp
+except ImportError:
+    # aiohttp is optional; without it the searches run on a thread pool instead
+    aiohttp = None
+
+try:
+    import diskcache
+except ImportError:
+    # diskcache is optional; without it metadata is only cached for the current run
+    diskcache = None
+
 def parser():
     # Create an argument parser
     parser = argparse.ArgumentParser(description='Script to run TNS queries on FRBs.')
@@ -43,43 +66,120 @@ def parser():
     return parser.parse_args()
 
 
+logger = logging.getLogger(__name__)
+
+SEARCH_URL = 'https://www.wis-tns.org/api/get/search'
+
+# number of TNS requests kept in flight at once
+MAX_WORKERS = 16
+# optional minimum spacing (s) between two POSTs to TNS; 0 leaves pacing to the rate-limit headers
+MIN_REQUEST_INTERVAL = 0.0
+# upper limit on processes drawing maps; None uses every core
+MAX_PLOT_WORKERS = None
+
+_inflight = threading.BoundedSemaphore(MAX_WORKERS)
+_rate_lock = threading.Lock()
+_last_request = [0.0]
+# monotonic time before which no POST should go out, set when TNS reports an exhausted quota
+_rate_reset_at = [0.0]
+
+# TNS metadata rarely changes, so keep it across runs in here (needs diskcache)
+METADATA_CACHE_DIR = os.path.expanduser('~/.tns_cache')
+# classification and redshift do get updated, so cached entries are refetched after this many seconds
+METADATA_CACHE_EXPIRE = 7 * 24 * 3600
+
+_cache_lock = threading.Lock()
+_metadata_cache = {}
+_disk_cache = []
+
+
+def make_session(pool_connections=16, pool_maxsize=32):
+    session = requests.Session()
+    # retry transient server errors at the connection level; 429s are handled by tns_query's backoff.
+    # raise_on_status=False hands the last 5xx back as a response, so callers keep their own
+    # status handling (raise_for_status in tns_query, the error print in get_metadata)
+    retries = Retry(total=3, backoff_factor=1, status_forcelist=[500, 502, 503, 504],
+                    allowed_methods=frozenset(['POST']), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=retries)
+    session.mount('https://', adapter)
+    return session
+
+
+# one keep-alive session shared by every TNS call, so connections (and TLS handshakes) are reused
+_SESSION = make_session()
+
+
+def get_session(session=None):
+    session = session or _SESSION
+    # the bot marker is only known once the env vars are set, so add it on first use
+    if 'tns_marker' not in session.headers.get('User-Agent', ''):
+        session.headers['User-Agent'] = set_bot_tns_marker()
+    return session
+
+
+def next_request_wait():
+    # seconds to hold the next POST back: until the TNS quota window resets, and/or the optional spacing
+    with _rate_lock:
+        now = time.monotonic()
+        start = max(now, _rate_reset_at[0], _last_request[0] + MIN_REQUEST_INTERVAL)
+        # book the slot now, so waiting threads don't all go out at the same moment
+        _last_request[0] = start
+        return start - now
+
+
+def throttle():
+    wait = next_request_wait()
+    if wait > 0:
+        time.sleep(wait)
+
+
+def update_rate_limit(headers):
+    """
+    Pace the next requests from the TNS rate-limit headers of a response.
+
+    TNS reports how many calls are left in the current window (x-rate-limit-remaining) and
+    the seconds until it resets (x-rate-limit-reset); once the quota is used up, hold every
+    further POST until the reset. Missing or malformed headers are ignored, and a 429 still
+    falls back to the exponential backoff of the callers.
+    """
+    try:
+        remaining = int(headers.get('x-rate-limit-remaining'))
+        reset = float(headers.get('x-rate-limit-reset'))
+    except (TypeError, ValueError):
+        return
+    if remaining <= 0:
+        with _rate_lock:
+            _rate_reset_at[0] = max(_rate_reset_at[0], time.monotonic() + reset)
+
+
+def post_tns(url, data, session=None):
+    # every synchronous TNS POST goes through here: paced by throttle(), bounded by _inflight
+    throttle()
+    with _inflight:
+        response = get_session(session).post(url, data=data)
+    update_rate_limit(response.headers)
+    return response
+
+
 def check_tns_api_keywords():
     for key in ['TNS_BOT_ID','TNS_BOT_NAME','TNS_API_KEY']:
         if key not in os.environ.keys():
             raise Exception(f'Add {key} to your environmental variables.')
 
 
-def format_to_json(source):
+def search(json_list, session=None):
     try:
-        parsed = json.loads(source)
-        data = parsed.get('data')
-        reply = data.get('reply')
-        if reply is None:
-            print("Error: 'reply' key not found in JSON.")
-            return None
-        return reply
-    except json.JSONDecodeError as e:
-        print("Error decoding JSON:", e)
-        return None
-
-
-def search(json_list):
-    try:
-        search_url = 'https://www.wis-tns.org/api/get/search'
-        bot_id = os.environ['TNS_BOT_ID']
-        bot_name = os.environ['TNS_BOT_NAME']
         api_key = os.environ['TNS_API_KEY']
-        headers = {
-            'User-Agent': f'tns_marker{{"tns_id":{bot_id}, "type":"bot", "name":"{bot_name}"}}'}
-        json_file = OrderedDict(json_list)
+        json_file = dict(json_list)
         search_data = {'api_key': api_key, 'data': json.dumps(json_file)}
-        response = requests.post(search_url, headers=headers, data=search_data)
+        response = post_tns(SEARCH_URL, search_data, session=session)
         return response
     except Exception as e:
         return [None, 'Error message : \n' + str(e)]
 
 
-def tns_query(ra, dec, radius, frb_name, units='arcmin', initial_delay=10, max_delay=300, outfile='query_results_final.txt'):
+def tns_query(ra, dec, radius, frb_name, units='arcmin', initial_delay=10, max_delay=300, outfile='query_results_final.txt',
+              session=None):
 
     '''
    Queries transients in TNS at the FRB position with a specfied radius.
@@ -90,6 +190,7 @@ def tns_query(ra, dec, radius, frb_name, units='arcmin', initial_delay=10, max_d
     dec (float): declination of the FRB
     radius (float): search radius in arcmin; default is 3
     frb_name (str): TNS name of the FRB
+    session (requests.Session): session to post with; defaults to the shared module session
     
     Returns: 
     --------
@@ -103,7 +204,7 @@ def tns_query(ra, dec, radius, frb_name, units='arcmin', initial_delay=10, max_d
     attempt = 0
     results_dict = {}
     while True:
-        response = search(search_obj)
+        response = search(search_obj, session=session)
         if response.status_code == 429:
             if attempt < max_retries:
                 print(f"Throttled. Retrying in {delay} seconds... (Attempt {attempt + 1}/{max_retries})")
@@ -115,22 +216,15 @@ def tns_query(ra, dec, radius, frb_name, units='arcmin', initial_delay=10, max_d
                 break
         else:
             response.raise_for_status()
-            result = format_to_json(response.text)
-            if result:
-                for item in result:
-                    if item['prefix'] == 'FRB':
-                            print(f"Skipping object with FRB prefix: {item['objname']}")
-                            continue 
-                    obj_id = item['objid']
-                    results_dict[obj_id] = {
-                        'FRB Name': frb_name,
-                        'Object Name': item['objname'],
-                        'Prefix': item['prefix'],
-                        'Object ID': obj_id
-                    }
-                print(f"Results for {frb_name} have been added to the dictionary.")
-            else: 
-                print(f"No Results found for {frb_name}")
+            try:
+                result = response.json()['data']['reply']
+            except ValueError as e:
+                print("Error decoding JSON:", e)
+                result = None
+            except (KeyError, TypeError):
+                print("Error: 'reply' key not found in JSON.")
+                result = None
+            results_dict = collect_results(result, frb_name)
             break
             # if you want to write them into a file
             #if result:
@@ -141,7 +235,121 @@ def tns_query(ra, dec, radius, frb_name, units='arcmin', initial_delay=10, max_d
             #    return outfile
     return results_dict
 
+
+def collect_results(result, frb_name):
+    # turn the 'reply' list of a TNS search into the per-transient dict returned by tns_query
+    if not result:
+        print(f"No Results found for {frb_name}")
+        return {}
+    results_dict = {
+        item['objid']: {
+            'FRB Name': frb_name,
+            'Object Name': item['objname'],
+            'Prefix': item['prefix'],
+            'Object ID': item['objid']
+        }
+        for item in result if item['prefix'] != 'FRB'
+    }
+    if logger.isEnabledFor(logging.DEBUG):
+        for item in result:
+            if item['prefix'] == 'FRB':
+                logger.debug(f"Skipping object with FRB prefix: {item['objname']}")
+    print(f"Results for {frb_name} have been added to the dictionary.")
+    return results_dict
+
+
+async def throttle_async():
+    # event-loop version of throttle(); the lock in next_request_wait is never held while sleeping
+    wait = next_request_wait()
+    if wait > 0:
+        await asyncio.sleep(wait)
+
+
+async def tns_query_async(session, ra, dec, radius, frb_name, units='arcmin', initial_delay=10, max_delay=300,
+                          semaphore=None):
+
+    '''
+    Coroutine version of tns_query for aiohttp, with the same exponential backoff on 429.
+    5xx replies are retried in the same loop, standing in for the urllib3 retries of the
+    requests session.
+
+    Parameters: 
+    -----------
+    session (aiohttp.ClientSession): session to post with, carrying the TNS bot marker
+    ra (float): right ascension of the FRB  
+    dec (float): declination of the FRB
+    radius (float): search radius in arcmin
+    frb_name (str): TNS name of the FRB
+    semaphore (asyncio.Semaphore): bounds the number of requests in flight
+    
+    Returns: 
+    --------
+    query output: dict
+        a dictionary of transients found within the search radius near an FRB position
+    '''
+
+    search_obj = [("ra", ra), ("dec", dec), ("radius", radius), ("units", units)]
+    search_data = {'api_key': os.environ['TNS_API_KEY'], 'data': json.dumps(dict(search_obj))}
+    semaphore = semaphore or asyncio.Semaphore(MAX_WORKERS)
+    max_retries = 8
+    delay = initial_delay
+    for attempt in range(max_retries + 1):
+        await throttle_async()
+        async with semaphore:
+            async with session.post(SEARCH_URL, data=search_data) as response:
+                update_rate_limit(response.headers)
+                status = response.status
+                if status != 429 and status < 500:
+                    response.raise_for_status()
+                    try:
+                        result = (await response.json(content_type=None))['data']['reply']
+                    except ValueError as e:
+                        print("Error decoding JSON:", e)
+                        result = None
+                    except (KeyError, TypeError):
+                        print("Error: 'reply' key not found in JSON.")
+                        result = None
+                    return collect_results(result, frb_name)
+        if attempt < max_retries:
+            # sleep outside the semaphore so other FRBs keep going
+            reason = "Throttled" if status == 429 else f"Server error {status}"
+            print(f"{reason}. Retrying in {delay} seconds... (Attempt {attempt + 1}/{max_retries})")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, max_delay)  # Exponential backoff
+    print("All retry attempts failed. Unable to get a successful response.")
+    return {}
+
+
+async def _gather_all(frb_rows, radius):
+    # run tns_query_async for every (name, ra, dec) row on one event loop; a row that still
+    # fails comes back as its exception instead of cancelling every other row
+    connector = aiohttp.TCPConnector(limit=32)
+    headers = {'User-Agent': set_bot_tns_marker()}
+    async with aiohttp.ClientSession(connector=connector, headers=headers) as session:
+        semaphore = asyncio.Semaphore(MAX_WORKERS)
+        return await asyncio.gather(*[tns_query_async(session, r, d, radius, n, semaphore=semaphore)
+                                      for n, r, d in frb_rows], return_exceptions=True)
+
+
+def event_loop_running():
+    # asyncio.run() can't be nested, e.g. when main() is called from Jupyter
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
 # this is for getting metadata
+def get_disk_cache():
+    # opened lazily so importing the script doesn't touch the home directory
+    if diskcache is None:
+        return None
+    with _cache_lock:
+        if not _disk_cache:
+            _disk_cache.append(diskcache.Cache(METADATA_CACHE_DIR))
+    return _disk_cache[0]
+
+
 def set_bot_tns_marker():
     bot_id = os.environ['TNS_BOT_ID']
     bot_name = os.environ['TNS_BOT_NAME']
@@ -149,49 +357,114 @@ def set_bot_tns_marker():
     return tns_marker
 
 
-def get_metadata(objname):
+def get_metadata(objname, session=None, initial_delay=10, max_delay=300):
     """
     Obtain all metadata (z, discovery date, classification, etc.) for a given transient.
+    Throttled (429) replies are retried with the same exponential backoff as tns_query.
 
     Parameters:
     objname (str): name of the transient
+    session (requests.Session): session to post with; defaults to the shared module session
+    initial_delay (float): first backoff delay in seconds after a 429
+    max_delay (float): cap on the backoff delay in seconds
 
     Returns:
     json: metadata associated with the transient
     """
+    if objname in _metadata_cache:
+        return _metadata_cache[objname]
+    disk_cache = get_disk_cache()
+    # a single get(): the entry may expire between a membership test and the lookup
+    cached = disk_cache.get(objname) if disk_cache is not None else None
+    if cached is not None:
+        _metadata_cache[objname] = cached
+        return cached
+
     TNS = "sandbox.wis-tns.org"
     url_tns_api = "https://" + TNS + "/api/get" 
     get_url = url_tns_api + "/object"
     api_key = os.environ['TNS_API_KEY']
-    tns_marker = set_bot_tns_marker()
-    headers = {'User-Agent': tns_marker}
     get_obj = [("objname", objname), ("objid", "")]
-    json_file = OrderedDict(get_obj)
+    json_file = dict(get_obj)
     get_data = {'api_key': api_key, 'data': json.dumps(json_file)}
-    response = requests.post(get_url, headers=headers, data=get_data)
+    max_retries = 8
+    delay = initial_delay
+    for attempt in range(max_retries + 1):
+        response = post_tns(get_url, get_data, session=session)
+        if response.status_code != 429:
+            break
+        if attempt < max_retries:
+            print(f"Throttled fetching {objname}. Retrying in {delay} seconds... (Attempt {attempt + 1}/{max_retries})")
+            time.sleep(delay)
+            delay = min(delay * 2, max_delay)  # Exponential backoff
     if response.status_code == 200:
-        return json.loads(response.text, object_pairs_hook=OrderedDict)
+        metadata = response.json()
+        _metadata_cache[objname] = metadata
+        # TNS also answers 200 for unknown names; only keep real objects across runs
+        reply = (metadata.get('data') or {}).get('reply') or {}
+        if disk_cache is not None and reply.get('objid'):
+            disk_cache.set(objname, metadata, expire=METADATA_CACHE_EXPIRE)
+        return metadata
     else:
         print(f"Error fetching metadata for {objname}: {response.status_code}")
         return None
 
 
+def check_unique_names(name, filename):
+    # transients are matched back to their FRB by name, so a repeated name would mix up two rows
+    names, counts = np.unique(name, return_counts=True)
+    if (counts > 1).any():
+        raise ValueError(f"Duplicate FRB names in {filename}: {', '.join(map(str, names[counts > 1]))}")
+
+
 def read_final_catalog(filename):
+    # reuse the parsed columns from <filename>.npz as long as the catalog hasn't changed since
+    cache_file = filename + '.npz'
+    mtime = os.path.getmtime(filename)
+    if os.path.exists(cache_file):
+        try:
+            with np.load(cache_file) as cached:
+                if cached['mtime'] == mtime:
+                    columns = tuple(cached[key] for key in ('name', 'ra', 'dec', 'theta', 'a', 'b'))
+                    check_unique_names(columns[0], filename)
+                    return columns
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile) as e:
+            # unreadable or partial cache: just parse the catalog again
+            print(f"Ignoring catalog cache {cache_file}: {e}")
+
     f = ascii.read(filename)
 
     filtered_f = f[f['include'] == 'yes']
     
-    name = np.array(filtered_f['name'].data)
-    ra = np.array(filtered_f['ra_frb'].data)
-    dec = np.array(filtered_f['dec_frb'].data)
-    theta = np.array(filtered_f['theta'].data)
-    b = np.array(filtered_f['b_err'].data)
-    a = np.array(filtered_f['a_err'].data)
+    # one structured array; the columns below are views into it rather than copies
+    arr = np.asarray(filtered_f.as_array())
+    name = arr['name']
+    ra = arr['ra_frb']
+    dec = arr['dec_frb']
+    theta = arr['theta']
+    b = arr['b_err']
+    a = arr['a_err']
     #DM = filtered_f['DM'].data
+    check_unique_names(name, filename)
+
+    # write to a temporary file and rename, so a crash never leaves a half-written cache
+    tmp_file = cache_file + '.tmp'
+    try:
+        with open(tmp_file, 'wb') as fh:
+            np.savez(fh, mtime=mtime, name=name, ra=ra, dec=dec, theta=theta, a=a, b=b)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        print(f"Could not cache catalog to {cache_file}: {e}")
+        # don't leave the partial file next to the user's catalog
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
   
     return name, ra, dec, theta, a, b
 
 
+@njit(fastmath=True, cache=True)
 def cov_matrix(a, b, theta):
 
     """
@@ -208,16 +481,40 @@ def cov_matrix(a, b, theta):
 
     # Convert theta to radians
     theta_rad = np.radians(theta + 90)  # Adjust angle for correct orientation
-    # Rotation matrix for an ellipse with position angle
-    R = np.array([[np.cos(theta_rad), -np.sin(theta_rad)], 
-                  [np.sin(theta_rad), np.cos(theta_rad)]])
-    # Diagonal matrix with square of semi-major and semi-minor axes
-    D = np.diag([a**2, b**2])
-    # Covariance matrix
-    covariance_matrix = R @ D @ R.T
+    c = np.cos(theta_rad)
+    s = np.sin(theta_rad)
+    # Covariance matrix R @ diag(a**2, b**2) @ R.T, written out element by element
+    covariance_matrix = np.empty((2, 2))
+    covariance_matrix[0, 0] = a**2 * c**2 + b**2 * s**2
+    covariance_matrix[1, 1] = a**2 * s**2 + b**2 * c**2
+    covariance_matrix[0, 1] = covariance_matrix[1, 0] = (a**2 - b**2) * c * s
     return covariance_matrix
 
 
+def cov_matrix_batch(a, b, theta):
+    """
+    Vectorized cov_matrix: covariance matrices for a whole catalog of ellipses at once.
+
+    Parameters:
+    a (array-like): Semi-major axes of the ellipses
+    b (array-like): Semi-minor axes of the ellipses
+    theta (array-like): Position angles of the ellipses in degrees
+
+    Returns:
+    np.ndarray: (N, 2, 2) array of covariance matrices
+    """
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+    theta_rad = np.radians(np.asarray(theta, dtype=float) + 90)
+    c, s = np.cos(theta_rad), np.sin(theta_rad)
+    R = np.stack([[c, -s], [s, c]]).transpose(2, 0, 1)
+    D = np.zeros((len(a), 2, 2))
+    D[:, 0, 0] = a**2
+    D[:, 1, 1] = b**2
+    # R @ D @ R.T for every ellipse
+    return np.einsum('nij,njk,nlk->nil', R, D, R)
+
+
 def mahalanobis_distance(point, frbcenter, cov_matrix):
     """
     Calculate the Mahalanobis distance between a given point and the center.
@@ -231,25 +528,112 @@ def mahalanobis_distance(point, frbcenter, cov_matrix):
     Returns:
     float: The Mahalanobis distance.
     """
+    # the jitted kernel wants arrays; lists would go through numba's deprecated reflected-list path
+    return _mahalanobis_distance(np.asarray(point, dtype=np.float64), np.asarray(frbcenter, dtype=np.float64),
+                                 np.asarray(cov_matrix, dtype=np.float64))
+
 
+@njit(fastmath=True, cache=True)
+def _mahalanobis_distance(point, frbcenter, cov_matrix):
     # the frbcenter in this case is the 'mean'
-    diff = np.array(point) - np.array(frbcenter)
+    diff_ra = point[0] - frbcenter[0]
+    diff_dec = point[1] - frbcenter[1]
     
     # correction term for spherical geometry
-    correction = diff[0] * (1 / np.cos(np.radians(point[1])))
-    diff_corrected = np.array([correction, diff[1]])
-    inv_cov_matrix = np.linalg.inv(cov_matrix)
-    md = np.sqrt(diff_corrected.T @ inv_cov_matrix @ diff_corrected)
+    correction = diff_ra * (1 / np.cos(np.radians(point[1])))
+    d0, d1 = correction, diff_dec
+    # closed-form 2x2 quadratic form d^T C^-1 d, no LAPACK inverse needed
+    a11, a12 = cov_matrix[0, 0], cov_matrix[0, 1]
+    a21, a22 = cov_matrix[1, 0], cov_matrix[1, 1]
+    det = a11 * a22 - a12 * a21
+    md = np.sqrt((d0 * (a22 * d0 - a12 * d1) + d1 * (a11 * d1 - a21 * d0)) / det)
     
     return md
 
 
+def in_bounding_box(points, frbcenters, cov_matrices, level=0.9999):
+    """
+    Cheap prefilter: is each transient inside the axis-aligned box around its FRB's confidence ellipse?
+
+    Anything outside the box is also outside the ellipse at the given level, so it can be
+    dropped before computing Mahalanobis distances.
+
+    Parameters:
+    points (array-like): (T, 2) transient positions as [RA, Dec].
+    frbcenters (array-like): (T, 2) FRB centers matched to each transient.
+    cov_matrices (array-like): (T, 2, 2) FRB covariance matrices matched to each transient.
+    level (float): Confidence level of the ellipse (default: 0.9999).
+
+    Returns:
+    np.ndarray: (T,) boolean mask of the transients inside the box.
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    frbcenters = np.asarray(frbcenters, dtype=float).reshape(-1, 2)
+    cov_matrices = np.asarray(cov_matrices, dtype=float).reshape(-1, 2, 2)
+
+    threshold = _chi2_ppf2(level)
+    # half-widths of the ellipse d^T C^-1 d = threshold along each axis
+    rmax_ra = np.sqrt(threshold * cov_matrices[:, 0, 0])
+    rmax_dec = np.sqrt(threshold * cov_matrices[:, 1, 1])
+    # same spherical correction on RA as in mahalanobis_distance
+    d_ra = np.abs(points[:, 0] - frbcenters[:, 0]) / np.cos(np.radians(points[:, 1]))
+    d_dec = np.abs(points[:, 1] - frbcenters[:, 1])
+    return (d_ra <= rmax_ra) & (d_dec <= rmax_dec)
+
+
+def mahalanobis_distance_batch(points, frbcenters, cov_matrices):
+    """
+    Vectorized mahalanobis_distance for many (transient, FRB) pairs at once.
+
+    Parameters:
+    points (array-like): (T, 2) transient positions as [RA, Dec].
+    frbcenters (array-like): (T, 2) FRB centers matched to each transient.
+    cov_matrices (array-like): (T, 2, 2) FRB covariance matrices matched to each transient.
+
+    Returns:
+    np.ndarray: (T,) Mahalanobis distances.
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    frbcenters = np.asarray(frbcenters, dtype=float).reshape(-1, 2)
+    cov_matrices = np.asarray(cov_matrices, dtype=float).reshape(-1, 2, 2)
+
+    diffs = points - frbcenters
+    # correction term for spherical geometry
+    diffs[:, 0] /= np.cos(np.radians(points[:, 1]))
+    # same closed-form 2x2 quadratic form as mahalanobis_distance
+    d0, d1 = diffs[:, 0], diffs[:, 1]
+    a11, a12 = cov_matrices[:, 0, 0], cov_matrices[:, 0, 1]
+    a21, a22 = cov_matrices[:, 1, 0], cov_matrices[:, 1, 1]
+    det = a11 * a22 - a12 * a21
+    return np.sqrt((d0 * (a22 * d0 - a12 * d1) + d1 * (a11 * d1 - a21 * d0)) / det)
+
+
+# closed forms of the chi-square distribution for df=2; expm1/log1p keep them accurate near 0 and 1
+@njit(fastmath=True, cache=True)
+def _chi2_cdf2(x):
+    return -np.expm1(-0.5 * x)
+
+
+def _chi2_ppf2(p):
+    return -2.0 * np.log1p(-p)
+
+
+@njit(fastmath=True, cache=True)
 def percentile(mahalanobis_distance, df=2):
-    p_value = chi2.cdf(mahalanobis_distance**2, df)
+    if df != 2:
+        raise ValueError('percentile only supports df=2')
+    p_value = _chi2_cdf2(mahalanobis_distance**2)
     return p_value
 
+
+if HAS_NUMBA:
+    # compile the kernels at import so the first FRB doesn't pay the JIT cost
+    cov_matrix(1.0, 1.0, 0.0)
+    mahalanobis_distance([1.0, 0.0], [0.0, 0.0], np.eye(2))
+    percentile(1.0)
+
 def gauss_contour(frbcenter, cov_matrix, semi_major, transient_name,
-                  transient_position=None, levels=[0.68, 0.95, 0.99]):
+                  transient_position=None, levels=[0.68, 0.95, 0.99], md=None, fig=None):
     
     """
     Plot Gaussian contours around a given FRB center based on its covariance matrix.
@@ -266,7 +650,18 @@ def gauss_contour(frbcenter, cov_matrix, semi_major, transient_name,
     transient_name (str): The name of the transient source.
     transient_position (Astropy SkyCoord): Transient position.
     levels: List of confidence levels for the contours (default: [0.68, 0.95, 0.99]).
+    md (float): Precomputed Mahalanobis distance of the transient; computed here if not given.
+    fig (matplotlib.figure.Figure): Figure to clear and draw on; pass the one returned by a
+        previous call to reuse it across maps. A new figure is made if not given.
+
+    Returns:
+    matplotlib.figure.Figure: the figure the map was drawn on.
     """
+    # plotting imports are deferred so runs that never plot don't pay for them
+    from matplotlib.patches import Ellipse
+    from matplotlib.figure import Figure
+    import matplotlib
+    import ligo.skymap.plot # KEEP: needed for projections in matplotlib
     
     eigvals, eigvecs = np.linalg.eigh(cov_matrix)
     order = eigvals.argsort()[::-1]
@@ -275,12 +670,15 @@ def gauss_contour(frbcenter, cov_matrix, semi_major, transient_name,
     
     width, height = 2 * np.sqrt(eigvals)
     theta = np.degrees(np.arctan2(*eigvecs[:, 0][::-1]))
-    threshold = chi2.ppf(0.9999, df=2)
     
-    fig = plt.figure(figsize=(6, 6))
+    # a bare Figure stays out of pyplot's global state, so it never has to be closed
+    if fig is None:
+        fig = Figure(figsize=(6, 6))
+    else:
+        fig.clf()
     # 2 arcmins size, quite arbitrary so can be changed
     size = 2 #semi_major*60*80
-    ax = plt.axes(
+    ax = fig.add_subplot(
     projection='astro zoom',
     center=frbcenter,
     radius=size*u.arcmin)
@@ -292,19 +690,23 @@ def gauss_contour(frbcenter, cov_matrix, semi_major, transient_name,
     
     cmap = matplotlib.colormaps.get_cmap('viridis')
 
-    for i, level in enumerate(levels):
-        chi_square_val = chi2.ppf(level, 2)
-        color = cmap(i / len(levels))
+    # everything that doesn't depend on the patch is computed once, outside the loop
+    scales = np.sqrt(_chi2_ppf2(np.asarray(levels)))
+    widths, heights = width * scales, height * scales
+    colors = cmap(np.arange(len(levels)) / len(levels))
+    center = (frbcenter.ra.deg, frbcenter.dec.deg)
+    world = ax.get_transform('world')
+    for w, h, color, level in zip(widths, heights, colors, levels):
         ellipse = Ellipse(
-            xy=(frbcenter.ra.deg, frbcenter.dec.deg),
-            width=width * np.sqrt(chi_square_val),
-            height=height * np.sqrt(chi_square_val),
+            xy=center,
+            width=w,
+            height=h,
             angle=theta,
             edgecolor=color,
             fc='None',
             lw=2,
             label=f'{int(level*100)}%',
-            transform=ax.get_transform('world')
+            transform=world
         )
         ax.add_patch(ellipse)
     
@@ -314,8 +716,9 @@ def gauss_contour(frbcenter, cov_matrix, semi_major, transient_name,
                 color='#fb5607', marker='o', label=transient_name)
         
         
-        md = mahalanobis_distance([transient_position.ra.deg, transient_position.dec.deg],
-                                  [frbcenter.ra.deg, frbcenter.dec.deg], cov_matrix)
+        if md is None:
+            md = mahalanobis_distance((transient_position.ra.deg, transient_position.dec.deg),
+                                      (frbcenter.ra.deg, frbcenter.dec.deg), cov_matrix)
         pt = percentile(md)
         ax.annotate(f'{(1-pt)*100:.3f}%', xy=[transient_position.ra.deg, transient_position.dec.deg],
                     xytext=(12, 12), textcoords='offset points')     
@@ -324,8 +727,35 @@ def gauss_contour(frbcenter, cov_matrix, semi_major, transient_name,
     ax.set_ylabel('DEC (J2000)', fontsize=14)
     ax.legend(fontsize=10)
     ax.grid(False)
-    plt.tight_layout()
-    plt.savefig(f'{transient_name}_gaussian_map.png')
+    fig.tight_layout()
+    fig.savefig(f'{transient_name}_gaussian_map.png')
+    return fig
+
+
+# each plotting process keeps reusing its own figure
+_worker_fig = [None]
+
+
+def _plot_batch(jobs):
+    """
+    Draw a batch of Gaussian maps, in a worker process or in the main one.
+
+    Each job is a tuple of plain floats/arrays, (frb_ra, frb_dec, cov, semi_major, transient_name,
+    transient_ra, transient_dec, md, frb_outfile), so nothing astropy-specific is pickled.
+    If frb_outfile is set the map is also saved under that name.
+    """
+    if not jobs:
+        return
+    frb_ra, frb_dec, covs, semi_majors, transient_names, trans_ra, trans_dec, mds, frb_outfiles = zip(*jobs)
+    # one SkyCoord array per batch rather than two scalar SkyCoords per map
+    frbcenters = SkyCoord(ra=np.array(frb_ra), dec=np.array(frb_dec), unit='deg')
+    transient_positions = SkyCoord(ra=np.array(trans_ra), dec=np.array(trans_dec), unit='deg')
+    for i, frb_outfile in enumerate(frb_outfiles):
+        fig = gauss_contour(frbcenters[i], covs[i], semi_majors[i], transient_names[i],
+                            transient_positions[i], md=mds[i], fig=_worker_fig[0])
+        _worker_fig[0] = fig
+        if frb_outfile:
+            fig.savefig(frb_outfile)
 
 
 def main(filename, name, ra, dec, theta, a, b, radius, single_obj=False):
@@ -349,23 +779,41 @@ def main(filename, name, ra, dec, theta, a, b, radius, single_obj=False):
     2D Gaussian map: png
     """ 
      
+    session = get_session()
     trans_results = {}
     if not single_obj:
         name, ra, dec, theta, a, b = read_final_catalog(filename)
-        for n, r, d in zip(name, ra, dec):
-            frb_results = tns_query(r, d, frb_name=n, radius=radius)
-            trans_results.update(frb_results)
+        # the queries are network bound, so keep several of them in flight
+        if aiohttp is not None and not event_loop_running():
+            all_results = asyncio.run(_gather_all(zip(name, ra, dec), radius))
+            for n, frb_results in zip(name, all_results):
+                if isinstance(frb_results, Exception):
+                    print(f"Query for {n} failed, skipping it: {frb_results!r}")
+                    continue
+                trans_results.update(frb_results)
+        else:
+            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+                futures = [ex.submit(tns_query, r, d, radius, n, session=session)
+                           for n, r, d in zip(name, ra, dec)]
+                # merge in catalog order, so a transient near two FRBs goes to the later row as before
+                for future in futures:
+                    trans_results.update(future.result())
     else:
-        frb_results = tns_query(ra, dec, frb_name=name, radius=radius)
+        frb_results = tns_query(ra, dec, frb_name=name, radius=radius, session=session)
         trans_results.update(frb_results)
 
     #grab all the metadata from TNS for the transients
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        futures = {}
+        for obj_id, data in trans_results.items():
+            print(f"Fetching metadata for object: {data['Object Name']}")
+            futures[ex.submit(get_metadata, data['Object Name'], session)] = obj_id
+        all_metadata = {obj_id: f.result() for f, obj_id in futures.items()}
+
     trans_metadata = {}
     for obj_id, data in trans_results.items():
-        objname = data['Object Name']
         FRBname = data['FRB Name']
-        print(f'Fetching metadata for object: {objname}')
-        metadata = get_metadata(objname)
+        metadata = all_metadata[obj_id]
         # fill free to add anything other info you want from TNS
         if metadata:
             data = metadata.get('data',{}); reply = data.get('reply',{})
@@ -386,25 +834,59 @@ def main(filename, name, ra, dec, theta, a, b, radius, single_obj=False):
             trans_metadata[obj_id] = formatted_data
 
     if single_obj:
+        cov = cov_matrix(a, b, theta)
         for obj_id, data in trans_metadata.items():
-            cov = cov_matrix(a, b, theta)
+            # same 99.99% box prefilter as the batch branch
+            if not in_bounding_box([data['radeg'], data['decdeg']], [ra, dec], cov)[0]:
+                continue
             transient_pos = SkyCoord(ra=data['radeg'], dec=data['decdeg'], unit='deg')
             frbcenter = SkyCoord(ra=ra, dec=dec, unit='deg')
             gauss_contour(frbcenter, cov, a, data['objname'], transient_pos)
             break  # Exit the loop after finding a match
     else:
-        # now we plot the 2D Gaussian maps 
-        for n, r, d, t, a, b in zip(name, ra, dec, theta, a, b):
-            for obj_id, data in trans_metadata.items():
-                if data['frbname'] == n:
-                    # semi-minor goes first
-                    cov = cov_matrix(a,b,t)
-                    transient_pos = SkyCoord(ra=data['radeg'],dec=data['decdeg'],unit='deg')
-                    frbcenter = SkyCoord(ra=r,dec=d,unit='deg')
-                    gauss_contour(frbcenter, cov, a, data['objname'], transient_pos)
-                        
-                    # Save the plot as a PNG file
-                    plt.savefig(f'{n}_gaussian_map.png')
+        covs = cov_matrix_batch(a, b, theta)
+
+        # score every transient against its FRB in one go, looked up by obj_id when plotting
+        frb_index = {n: i for i, n in enumerate(name)}
+        obj_ids = list(trans_metadata)
+        idx = np.array([frb_index[trans_metadata[o]['frbname']] for o in obj_ids], dtype=int)
+        points = np.array([[trans_metadata[o]['radeg'], trans_metadata[o]['decdeg']] for o in obj_ids],
+                          dtype=float).reshape(-1, 2)
+        centers = np.column_stack([ra, dec])[idx]
+        # transients outside the 99.99% box are neither scored nor plotted
+        inside = in_bounding_box(points, centers, covs[idx])
+        obj_ids = [o for o, keep in zip(obj_ids, inside) if keep]
+        md_lookup = dict(zip(obj_ids, mahalanobis_distance_batch(points[inside], centers[inside],
+                                                                 covs[idx][inside])))
+
+        row_of = dict(zip(obj_ids, np.flatnonzero(inside)))
+
+        # index the transients by FRB once instead of scanning all of them per FRB
+        by_frb = defaultdict(list)
+        for obj_id in obj_ids:
+            by_frb[trans_metadata[obj_id]['frbname']].append(obj_id)
+
+        # now we plot the 2D Gaussian maps; each one is independent, so spread them over the cores
+        jobs = []
+        for i, (n, a_i) in enumerate(zip(name, a)):
+            frb_obj_ids = by_frb.get(n, [])
+            for obj_id in frb_obj_ids:
+                trans_ra, trans_dec = points[row_of[obj_id]]
+                # the map of the FRB's last transient is also saved under the FRB name
+                frb_outfile = f'{n}_gaussian_map.png' if obj_id == frb_obj_ids[-1] else None
+                jobs.append((float(ra[i]), float(dec[i]), covs[i], a_i, trans_metadata[obj_id]['objname'],
+                             trans_ra, trans_dec, md_lookup[obj_id], frb_outfile))
+
+        # worker start-up (and, under spawn, re-importing this module) only pays off for several maps
+        n_workers = min(len(jobs), MAX_PLOT_WORKERS or os.cpu_count() or 1)
+        if n_workers > 1:
+            # one contiguous batch per worker
+            bounds = np.linspace(0, len(jobs), n_workers + 1).astype(int)
+            batches = [jobs[lo:hi] for lo, hi in zip(bounds[:-1], bounds[1:])]
+            with ProcessPoolExecutor(max_workers=n_workers) as ex:
+                list(ex.map(_plot_batch, batches))
+        else:
+            _plot_batch(jobs)
 
 if __name__ == "__main__":
     # Verify that you've added these to your env var 